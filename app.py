@@ -1,15 +1,28 @@
 
+import importlib.machinery
 import io
-import csv
+import multiprocessing
+import os
 import re
 import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from itertools import repeat
 from pathlib import Path
 
-import segno
+import pandas as pd
 from PIL import Image, ImageOps
 import streamlit as st
 
+import qr_render
+
+# Streamlit runs this file as a __main__ module without a spec, so spawned batch workers
+# would re-execute the whole app as __mp_main__. A "__main__" spec makes multiprocessing skip that.
+if __spec__ is None:
+    __spec__ = importlib.machinery.ModuleSpec("__main__", None)
+
 # ----------------------------
 # App Config
 # ----------------------------
@@ -20,17 +33,26 @@ st.caption("Generate customized QR codes (PNG, SVG, PDF), add logos, and downloa
 if "qr_history" not in st.session_state:
     st.session_state.qr_history = []  # list of dicts
 
+HISTORY_THUMB_SIZE = 128  # px, longest side of history previews
+HISTORY_MAX_SHOWN = 10  # most recent entries rendered in the history section
+
 # ----------------------------
 # Helper Functions
 # ----------------------------
+_UNSAFE_CHARS_RE = re.compile(r"[^A-Za-z0-9._-]+")
+_UNDERSCORES_RE = re.compile(r"_+")
+
 def sanitize_filename(s: str, max_len: int = 50) -> str:
-    base = re.sub(r"[^A-Za-z0-9._-]+", "_", s.strip())
-    base = re.sub(r"_+", "_", base).strip("_")
+    base = _UNDERSCORES_RE.sub("_", _UNSAFE_CHARS_RE.sub("_", s.strip())).strip("_")
     return base[:max_len] or "qr_code"
 
-def add_logo_to_png(png_bytes: bytes, logo_img: Image.Image, ratio: float = 0.2, add_white_bg: bool = True) -> bytes:
-    """Composite a centered logo onto the QR PNG. ratio is fraction of QR width used by logo."""
-    qr_img = Image.open(io.BytesIO(png_bytes)).convert("RGBA")
+def add_logo(png_bytes: bytes, logo_img: Image.Image, ratio: float = 0.2, add_white_bg: bool = True) -> Image.Image:
+    """Composite a centered logo onto the QR PNG. ratio is fraction of QR width used by logo.
+    Returns the composited image; the caller encodes it once."""
+    qr_img = Image.open(io.BytesIO(png_bytes))
+    # An opaque logo tile can be pasted straight in; only keep alpha if the QR itself is transparent
+    has_alpha = qr_img.mode in ("RGBA", "LA") or "transparency" in qr_img.info
+    qr_img = qr_img.convert("RGBA" if has_alpha or not add_white_bg else "RGB")
     W, H = qr_img.size
     target_w = int(W * ratio)
     logo_img = logo_img.convert("RGBA")
@@ -40,42 +62,31 @@ def add_logo_to_png(png_bytes: bytes, logo_img: Image.Image, ratio: float = 0.2,
     if add_white_bg:
         pad = max(4, target_w // 20)
         bg_w, bg_h = logo_img.size[0] + pad * 2, logo_img.size[1] + pad * 2
-        bg = Image.new("RGBA", (bg_w, bg_h), (255, 255, 255, 255))
+        bg = Image.new(qr_img.mode, (bg_w, bg_h), "white")
         bg.paste(logo_img, (pad, pad), logo_img)
         logo_img = bg
 
     # Center placement
     pos = ((W - logo_img.size[0]) // 2, (H - logo_img.size[1]) // 2)
-    qr_img.alpha_composite(logo_img, dest=pos)
+    if qr_img.mode == "RGB":
+        qr_img.paste(logo_img, pos)
+    else:
+        qr_img.alpha_composite(logo_img, dest=pos)
+    return qr_img
 
+def encode_png(img: Image.Image) -> bytes:
+    """Encode a PIL image as PNG with fast deflate (compress_level=1)."""
     out = io.BytesIO()
-    qr_img.save(out, format="PNG")
-    out.seek(0)
+    img.save(out, format="PNG", compress_level=1, optimize=False)
     return out.getvalue()
 
-def make_png_background_transparent(png_bytes: bytes, bg_hex: str = "#FFFFFF") -> bytes:
-    """Turn a solid background color into transparent in a PNG."""
-    img = Image.open(io.BytesIO(png_bytes)).convert("RGBA")
-    # Parse hex color
-    bg_hex = bg_hex.lstrip("#")
-    bg_rgb = tuple(int(bg_hex[i:i+2], 16) for i in (0, 2, 4))
-
-    data = img.getdata()
-    new_data = []
-    for pixel in data:
-        r, g, b, a = pixel
-        if (r, g, b) == bg_rgb:
-            new_data.append((r, g, b, 0))  # transparent
-        else:
-            new_data.append(pixel)
-    img.putdata(new_data)
-
-    out = io.BytesIO()
-    img.save(out, format="PNG")
-    out.seek(0)
-    return out.getvalue()
+@st.cache_resource(max_entries=1024, show_spinner=False)
+def _make_qr(text: str, error: str, micro: bool, version: int | None, mask: int | None, boost_error: bool):
+    """Build (and memoize across reruns) the QR matrix; rendering options don't affect it."""
+    return qr_render.make_qr(text, error, micro, version, mask, boost_error)
 
 
+@st.cache_data(ttl=24 * 60 * 60, max_entries=256, show_spinner=False)
 def generate_qr(text: str,
                 error: str = "m",
                 micro: bool = False,
@@ -90,35 +101,15 @@ def generate_qr(text: str,
     """
     Returns dict of {png: bytes, svg: bytes, pdf: bytes}
     """
-    qr = segno.make(text, error=error, micro=micro, version=version, mask=mask, boost_error=boost_error)
-
-    # --- PNG (no 'transparent' kw for segno's PNG writer) ---
-    png_buffer = io.BytesIO()
-    qr.save(png_buffer, kind="png", scale=scale, border=border, dark=dark, light=light)
-    png_buffer.seek(0)
-    png_bytes = png_buffer.getvalue()
-
-    # Optional: make background transparent using PIL
-    if transparent:
-        png_bytes = make_png_background_transparent(png_bytes, bg_hex=light)
-
-    # --- SVG ---
-    svg_buffer = io.BytesIO()
-    qr.save(svg_buffer, kind="svg", scale=scale, border=border, dark=dark, light=light)
-    svg_buffer.seek(0)
-
-    # --- PDF ---
-    pdf_buffer = io.BytesIO()
-    qr.save(pdf_buffer, kind="pdf", border=border, dark=dark, light=light)
-    pdf_buffer.seek(0)
-
-    return {"png": png_bytes, "svg": svg_buffer.getvalue(), "pdf": pdf_buffer.getvalue()}
+    qr = _make_qr(text, error, micro, version, mask, boost_error)
+    return qr_render.render_outputs(qr, scale=scale, border=border, dark=dark, light=light, transparent=transparent)
 
 
+@st.cache_resource(show_spinner=False)
 def build_project_zip():
     """Create an in-memory ZIP of the project files."""
     project_dir = Path(__file__).resolve().parent
-    files = ["app.py", "requirements.txt", "README.md", "Dockerfile"]
+    files = ["app.py", "qr_render.py", "requirements.txt", "README.md", "Dockerfile"]
 
     zip_buf = io.BytesIO()
     with zipfile.ZipFile(zip_buf, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
@@ -192,7 +183,8 @@ if generate and text:
     if logo_file is not None:
         try:
             logo_img = Image.open(logo_file)
-            png_bytes = add_logo_to_png(png_bytes, logo_img, ratio=logo_ratio / 100.0, add_white_bg=True)
+            qr_img = add_logo(png_bytes, logo_img, ratio=logo_ratio / 100.0, add_white_bg=True)
+            png_bytes = encode_png(qr_img)
         except Exception as e:
             st.warning(f"Logo processing failed: {e}")
 
@@ -200,7 +192,7 @@ if generate and text:
     result["png"] = png_bytes
 
     # Preview
-    st.image(Image.open(io.BytesIO(result["png"])), caption="Generated QR Code", use_column_width=False)
+    st.image(result["png"], caption="Generated QR Code", use_column_width=False)
 
     # Filename base
     filename_base = sanitize_filename(text)
@@ -233,10 +225,14 @@ if generate and text:
             use_container_width=True
         )
 
-    # Save to history
+    # Save to history (with a small thumbnail so reruns don't re-send the full PNG)
+    # Palette PNGs would be resized with NEAREST, which drops module rows unevenly
+    thumb = Image.open(io.BytesIO(result["png"])).convert("RGBA")
+    thumb.thumbnail((HISTORY_THUMB_SIZE, HISTORY_THUMB_SIZE))
     st.session_state.qr_history.append({
         "text": text,
         "png": result["png"],
+        "thumb": encode_png(thumb),
         "svg": result["svg"],
         "pdf": result["pdf"],
         "filename_base": filename_base,
@@ -252,19 +248,64 @@ elif generate and not text:
 st.subheader("📦 Batch generate QR codes")
 batch_file = st.file_uploader("Upload a CSV or TXT (one value per line, or CSV with 'value' column).", type=["csv", "txt"], accept_multiple_files=False)
 
+BATCH_POOL_MIN_VALUES = 256  # distinct values before rendering is worth farming out to worker processes
+
+def _render_one(v: str, opts: tuple):
+    """Render one batch value through the cached generate_qr, return (base, png, svg, pdf)."""
+    files = generate_qr(v, *opts)
+    return sanitize_filename(v), files["png"], files["svg"], files["pdf"]
+
+@st.cache_resource(show_spinner=False)
+def _get_render_pool(max_workers: int) -> ProcessPoolExecutor:
+    """Worker pool shared across reruns and sessions for large batches.
+    Spawned (not forked) so workers don't inherit Streamlit's threads and locks."""
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+def _render_unique(unique: list[str], opts: tuple):
+    """Yield (base, png, svg, pdf) for each value in order. Large batches go to the worker
+    pool (plain qr_render, no Streamlit); the rest, and anything left after a broken pool,
+    render here through the cached generate_qr."""
+    done = 0
+    if len(unique) >= BATCH_POOL_MIN_VALUES:
+        pool = _get_render_pool(min(os.cpu_count() or 1, len(unique)))
+        try:
+            results = pool.map(qr_render.render_qr, unique, *(repeat(o) for o in opts), chunksize=8)
+            for v, files in zip(unique, results):
+                yield sanitize_filename(v), files["png"], files["svg"], files["pdf"]
+                done += 1
+        except BrokenProcessPool:
+            # e.g. a worker was OOM-killed; drop the pool so the next batch gets a fresh one
+            _get_render_pool.clear()
+    for v in unique[done:]:
+        yield _render_one(v, opts)
+
 def build_zip_from_values(values: list[str],
                           error, micro, version, mask, boost_error, scale, border, dark, light, transparent):
+    opts = (error, micro, version, mask, boost_error, scale, border, dark, light, transparent)
+    values = [v.strip() for v in values if v.strip()]
+    # Render each distinct value once; duplicates reuse the bytes until their last occurrence
+    remaining = Counter(values)
+    unique = list(remaining)
+    rendered = {}
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    results = _render_unique(unique, opts)
+
     zip_buf = io.BytesIO()
-    with zipfile.ZipFile(zip_buf, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for v in values:
-            if not v.strip():
-                continue
-            files = generate_qr(v.strip(), error, micro, version, mask, boost_error, scale, border, dark, light, transparent)
-            base = sanitize_filename(v.strip())
-            ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-            zf.writestr(f"{base}_{ts}.png", files["png"])
-            zf.writestr(f"{base}_{ts}.svg", files["svg"])
-            zf.writestr(f"{base}_{ts}.pdf", files["pdf"])
+    # zipfile is not thread-safe, so writes stay serial here.
+    # PNG and PDF payloads are already deflated, so only SVG is worth compressing again.
+    with zipfile.ZipFile(zip_buf, mode="w", compression=zipfile.ZIP_STORED) as zf:
+        for i, v in enumerate(values):
+            if v not in rendered:
+                rendered[v] = next(results)
+            base, png, svg, pdf = rendered[v]
+            remaining[v] -= 1
+            if not remaining[v]:
+                del rendered[v]
+            # Row index keeps names unique for duplicate or colliding sanitized values
+            name = f"{base}_{ts}_{i:05d}"
+            zf.writestr(f"{name}.png", png)
+            zf.writestr(f"{name}.svg", svg, compress_type=zipfile.ZIP_DEFLATED)
+            zf.writestr(f"{name}.pdf", pdf)
     zip_buf.seek(0)
     return zip_buf
 
@@ -272,26 +313,28 @@ if batch_file is not None:
     values = []
     try:
         if batch_file.name.lower().endswith(".txt"):
-            for line in batch_file.getvalue().decode("utf-8", errors="ignore").splitlines():
-                values.append(line.strip())
+            batch_file.seek(0)
+            lines = io.TextIOWrapper(batch_file, encoding="utf-8", errors="ignore")
+            values = [line.strip() for line in lines if line.strip()]
+            lines.detach()  # don't let the wrapper close the upload
         else:
-            # CSV: try 'value' column; fallback to first column
-            content = batch_file.getvalue().decode("utf-8", errors="ignore").splitlines()
-            reader = csv.DictReader(content)
-            if reader.fieldnames:
-                if "value" in [f.lower() for f in reader.fieldnames]:
-                    # map case-insensitively
-                    key = [f for f in reader.fieldnames if f.lower() == "value"][0]
-                    for row in reader:
-                        values.append(str(row.get(key, "")).strip())
-                else:
-                    # fallback first column
-                    reader2 = csv.reader(content)
-                    for row in reader2:
-                        if row:
-                            values.append(str(row[0]).strip())
-            else:
+            # CSV: try 'value' column; fallback to first column (header row included, as before)
+            read_opts = dict(header=None, dtype=str, keep_default_na=False, encoding_errors="ignore")
+            try:
+                batch_file.seek(0)
+                first_row = pd.read_csv(batch_file, nrows=1, **read_opts)
+            except pd.errors.EmptyDataError:
+                first_row = pd.DataFrame()
+            if first_row.empty:
                 st.warning("CSV has no header/columns. Make sure it's a valid CSV.")
+            else:
+                header = [str(f).lower() for f in first_row.iloc[0]]
+                has_value_col = "value" in header
+                # usecols lets the C parser accept ragged rows instead of rejecting the whole file
+                batch_file.seek(0)
+                df = pd.read_csv(batch_file, usecols=[header.index("value") if has_value_col else 0], **read_opts)
+                column = df.iloc[1:, 0] if has_value_col else df.iloc[:, 0]
+                values = column.fillna("").str.strip().tolist()
     except Exception as e:
         st.error(f"Failed to parse file: {e}")
 
@@ -323,16 +366,24 @@ if st.session_state.qr_history:
         st.session_state.qr_history.clear()
         st.experimental_rerun()
 
-    for i, item in enumerate(reversed(st.session_state.qr_history), start=1):
-        st.markdown(f"**{i}.** {item['text']}")
-        st.image(Image.open(io.BytesIO(item["png"])), use_column_width=False)
-        colH1, colH2, colH3 = st.columns(3)
-        with colH1:
-            st.download_button("PNG", data=item["png"], file_name=f"{item['filename_base']}_{item['ts']}.png", mime="image/png")
-        with colH2:
-            st.download_button("SVG", data=item["svg"], file_name=f"{item['filename_base']}_{item['ts']}.svg", mime="image/svg+xml")
-        with colH3:
-            st.download_button("PDF", data=item["pdf"], file_name=f"{item['filename_base']}_{item['ts']}.pdf", mime="application/pdf")
+    history = st.session_state.qr_history
+    shown = history[-HISTORY_MAX_SHOWN:]
+    # Fixed label: expanders have no key, so a changing label would collapse it on every new QR
+    with st.expander("History", expanded=False):
+        if len(history) > HISTORY_MAX_SHOWN:
+            st.caption(f"Showing the latest {HISTORY_MAX_SHOWN} of {len(history)} QR codes.")
+        else:
+            st.caption(f"{len(history)} QR code(s) this session.")
+        for i, item in enumerate(reversed(shown), start=1):
+            st.markdown(f"**{i}.** {item['text']}")
+            st.image(item["thumb"], use_column_width=False)
+            colH1, colH2, colH3 = st.columns(3)
+            with colH1:
+                st.download_button("PNG", data=item["png"], file_name=f"{item['filename_base']}_{item['ts']}.png", mime="image/png")
+            with colH2:
+                st.download_button("SVG", data=item["svg"], file_name=f"{item['filename_base']}_{item['ts']}.svg", mime="image/svg+xml")
+            with colH3:
+                st.download_button("PDF", data=item["pdf"], file_name=f"{item['filename_base']}_{item['ts']}.pdf", mime="application/pdf")
 else:
     st.caption("No history yet. Generate a QR to see it here.")
 
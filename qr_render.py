@@ -0,0 +1,54 @@
+"""Pure QR rendering (no Streamlit), importable by batch worker processes."""
+import io
+
+import numpy as np
+import segno
+from PIL import Image
+
+
+def _hex_to_rgb(hex_color: str) -> tuple[int, int, int]:
+    hex_color = hex_color.lstrip("#")
+    return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+
+def make_qr(text: str, error: str, micro: bool, version: int | None, mask: int | None, boost_error: bool):
+    """Build the QR matrix; rendering options don't affect it."""
+    return segno.make(text, error=error, micro=micro, version=version, mask=mask, boost_error=boost_error)
+
+def render_png(qr, scale: int, border: int, dark: str, light: str, transparent: bool = False) -> bytes:
+    """Rasterize the QR module matrix with NumPy and encode it as a 1-bit palette PNG
+    (index 0 = light, 1 = dark; light becomes transparent if requested)."""
+    modules = np.array(qr.matrix, dtype=bool).astype(np.uint8)
+    modules = np.pad(modules, border, constant_values=0)
+    pixels = np.repeat(np.repeat(modules, scale, axis=0), scale, axis=1)
+
+    img = Image.fromarray(pixels)  # mode "L"; putpalette turns it into "P"
+    img.putpalette([*_hex_to_rgb(light), *_hex_to_rgb(dark)])
+
+    out = io.BytesIO()
+    if transparent:
+        img.save(out, format="PNG", bits=1, optimize=True, transparency=0)
+    else:
+        img.save(out, format="PNG", bits=1, optimize=True)
+    return out.getvalue()
+
+def render_outputs(qr, scale: int, border: int, dark: str, light: str, transparent: bool = False) -> dict:
+    """
+    Returns dict of {png: bytes, svg: bytes, pdf: bytes}
+    """
+    # --- SVG ---
+    svg_buffer = io.BytesIO()
+    qr.save(svg_buffer, kind="svg", scale=scale, border=border, dark=dark, light=light)
+
+    # --- PNG ---
+    png_bytes = render_png(qr, scale=scale, border=border, dark=dark, light=light, transparent=transparent)
+
+    # --- PDF ---
+    pdf_buffer = io.BytesIO()
+    qr.save(pdf_buffer, kind="pdf", border=border, dark=dark, light=light)
+
+    return {"png": png_bytes, "svg": svg_buffer.getvalue(), "pdf": pdf_buffer.getvalue()}
+
+def render_qr(text: str, error, micro, version, mask, boost_error, scale, border, dark, light, transparent) -> dict:
+    """Build and render one QR; same positional options as app.generate_qr."""
+    qr = make_qr(text, error, micro, version, mask, boost_error)
+    return render_outputs(qr, scale=scale, border=border, dark=dark, light=light, transparent=transparent)